@@ -11,12 +11,11 @@
 import numpy as np
 import pandas as pd
 import os
+import functools
 import scipy.optimize as opt
 import scipy.sparse as sps
 import scipy.spatial as spt
 import matplotlib.pyplot as plt
-import itertools
-import tqdm
 import pickle
 import sys
 import logging
@@ -31,6 +30,10 @@ DATA_COLOR = 'tab:blue'
 MODEL_COLOR = 'tab:red'
 MODEL_COLOR2 = 'tab:olive'
 
+# String representations of the 2nd and 3rd order models [so that models can be saved to file]
+EXP_MODEL = 'exp_model_scale * np.exp(-exp_model_exponent * np.array(d))'
+BIP_EXP_MODEL = 'np.select([np.array(dz) < 0, np.array(dz) > 0, np.array(dz) == 0], [bip_neg_exp_model_scale * np.exp(-bip_neg_exp_model_exponent * np.array(d)), bip_pos_exp_model_scale * np.exp(-bip_pos_exp_model_exponent * np.array(d)), 0.5 * (bip_neg_exp_model_scale * np.exp(-bip_neg_exp_model_exponent * np.array(d)) + bip_pos_exp_model_scale * np.exp(-bip_pos_exp_model_exponent * np.array(d)))])'
+
 ###################################################################################################
 # Wrapper function for running model building from a SLURM batch script (optionally, on different data splits)
 ###################################################################################################
@@ -938,50 +941,132 @@ def _get_data_part_name(N_split, part_idx):
     return f'__part-{N_split}-{part_idx:0{num_dig}}'
 
 
+def _exp_model(d, exp_model_scale, exp_model_exponent):
+    """Exponential distance-dependent conn. prob. (2nd order model; see EXP_MODEL)."""
+    return exp_model_scale * np.exp(-exp_model_exponent * np.array(d))
+
+
+def _bip_exp_model(d, dz, bip_neg_exp_model_scale, bip_neg_exp_model_exponent, bip_pos_exp_model_scale, bip_pos_exp_model_exponent):
+    """Bipolar exponential distance-dependent conn. prob. (3rd order model; see BIP_EXP_MODEL)."""
+    p_neg = bip_neg_exp_model_scale * np.exp(-bip_neg_exp_model_exponent * np.array(d))
+    p_pos = bip_pos_exp_model_scale * np.exp(-bip_pos_exp_model_exponent * np.array(d))
+    return np.select([np.array(dz) < 0, np.array(dz) > 0, np.array(dz) == 0], [p_neg, p_pos, 0.5 * (p_neg + p_pos)])
+
+
+MODEL_FUNCTIONS = {EXP_MODEL: _exp_model, BIP_EXP_MODEL: _bip_exp_model} # Pre-defined functions of known models
+
+
+@functools.lru_cache
+def _compile_model_function(model, model_inputs, model_param_names):
+    """Returns (cached) function of model inputs and parameters from string representation."""
+    if model in MODEL_FUNCTIONS:
+        return MODEL_FUNCTIONS[model]
+    input_param_str = ','.join(model_inputs + model_param_names) # String representation of input variables and model parameters
+    return eval(f'lambda {input_param_str}: {model}') # Build function
+
+
 def _get_model_function(model, model_inputs, model_params):
     """Returns model function from string representation [so any model function can be saved to file]."""
-    input_str = ','.join(model_inputs + ['model_params=model_params']) # String representation of input variables
-    input_param_str = ','.join(model_inputs + list(model_params.keys())) # String representation of input variables and model parameters
-    model_param_str = ','.join(model_inputs + ['**model_params']) # String representation propagating model parameters
+    model_fct = _compile_model_function(model, tuple(model_inputs), tuple(model_params.keys()))
 
-    inner_model_str = f'lambda {input_param_str}: {model}'
-    full_model_str = f'lambda {input_str}: ({inner_model_str})({model_param_str})' # Use nested lambdas to bind local variables
+    return functools.partial(model_fct, **model_params) # Bind model parameters
 
-    model_fct = eval(full_model_str) # Build function
 
-    # logging.info(f'Model function: {inner_model_str}')
+def _get_dist_bins(max_range_um, bin_size_um):
+    """Returns number of distance bins and bin edges covering the given max. range."""
+    num_bins = np.ceil(max_range_um / bin_size_um).astype(int)
+    dist_bins = np.arange(0, num_bins + 1) * bin_size_um
 
-    return model_fct
+    return num_bins, dist_bins
 
 
-def _compute_dist_matrix(src_nrn_pos, tgt_nrn_pos):
-    """Computes distance matrix between pairs of neurons."""
+def _compute_dist_matrix(src_nrn_pos, tgt_nrn_pos, max_range_um=None):
+    """Computes distance matrix between pairs of neurons.
+       If a max. range is given, a sparse (COO) matrix is returned that only
+       contains pairs of neurons within that range."""
+    if max_range_um is not None:
+        return _compute_sparse_dist_matrix(spt.cKDTree(src_nrn_pos), spt.cKDTree(tgt_nrn_pos), max_range_um)
+
     dist_mat = spt.distance_matrix(src_nrn_pos, tgt_nrn_pos)
     dist_mat[dist_mat == 0.0] = np.nan # Exclude autaptic connections
 
     return dist_mat
 
 
-def _compute_dist_matrix_symmetric(nrn_pos):
+def _compute_dist_matrix_symmetric(nrn_pos, max_range_um=None):
     """Computes symmetric distance matrix between pairs of neurons.
        Faster implementation to be used when source and target neurons
        are the same."""
+    if max_range_um is not None:
+        tree = spt.cKDTree(nrn_pos)
+        return _compute_sparse_dist_matrix(tree, tree, max_range_um)
+
     dist_mat = spt.distance.squareform(spt.distance.pdist(nrn_pos))
     dist_mat[dist_mat == 0.0] = np.nan # Exclude autaptic connections
 
     return dist_mat
 
 
+def _compute_sparse_dist_matrix(src_tree, tgt_tree, max_range_um):
+    """Computes sparse (COO) distance matrix between pairs of neurons within max. range,
+       based on KD-trees of neuron positions."""
+    pairs = src_tree.sparse_distance_matrix(tgt_tree, max_range_um, output_type='ndarray')
+    pairs = pairs[pairs['v'] > 0.0] # Exclude autaptic connections
+    dist_mat = sps.coo_matrix((pairs['v'], (pairs['i'], pairs['j'])), shape=(src_tree.n, tgt_tree.n))
+
+    return dist_mat
+
+
 def _compute_bip_matrix(src_depths, tgt_depths):
     """
     Computes bipolar matrix between pairs of neurons based on depth difference delta_d:
       POST-synaptic neuron below (delta_d < 0) or above (delta_d > 0) PRE-synaptic neuron
     """
-    bip_mat = np.sign(-np.diff(np.meshgrid(src_depths, tgt_depths, indexing='ij'), axis=0)[0, :, :])
+    src_depths = np.asarray(src_depths)
+    tgt_depths = np.asarray(tgt_depths)
+    bip_mat = np.sign(src_depths[:, np.newaxis] - tgt_depths[np.newaxis, :])
+    if np.all(np.isfinite(src_depths)) and np.all(np.isfinite(tgt_depths)):
+        bip_mat = bip_mat.astype(np.int8) # No NaNs to represent
 
     return bip_mat
 
 
+def _compute_bip_matrix_sparse(src_depths, tgt_depths, dist_mat):
+    """
+    Computes sparse (COO) bipolar matrix based on depth difference delta_d, only for the
+    pairs of neurons contained in a sparse (COO) distance matrix (see _compute_bip_matrix)
+    """
+    bip_values = np.sign(src_depths[dist_mat.row] - tgt_depths[dist_mat.col])
+    if np.all(np.isfinite(bip_values)):
+        bip_values = bip_values.astype(np.int8) # No NaNs to represent
+    bip_mat = sps.coo_matrix((bip_values, (dist_mat.row, dist_mat.col)), shape=dist_mat.shape) # Keeps explicit zeros
+
+    return bip_mat
+
+
+def _get_bin_indices(values, bins):
+    """Returns bin indices of given values (including last edge); values outside the range of bins get index -1."""
+    num_bins = len(bins) - 1
+    bin_idx = np.digitize(values, bins) - 1
+    bin_idx[values == bins[-1]] = num_bins - 1 # Including last edge
+    bin_idx[bin_idx >= num_bins] = -1 # Out of range (incl. NaNs)
+
+    return bin_idx
+
+
+def _add_bin_id_counts(counts, bin_ids, weights=None):
+    """Adds number of occurrences (or sum of weights) of each bin id to counts (in-place); ids beyond the range of counts are ignored."""
+    if len(bin_ids) >= len(counts): # Dense counting
+        counts += np.bincount(bin_ids, weights=weights, minlength=len(counts) + 1)[:len(counts)]
+    else: # Many more bins than samples: only count ids that actually occur
+        if weights is None:
+            id_counts = pd.Series(bin_ids).value_counts(sort=False)
+        else:
+            id_counts = pd.Series(weights).groupby(bin_ids).sum()
+        id_counts = id_counts[id_counts.index < len(counts)]
+        counts[id_counts.index.values] += id_counts.values
+
+
 def _extract_dependent_p_conn(adj, dep_matrices, dep_bins):
     """Extract D-dimensional conn. prob. dependent on D property matrices between source-target pairs of neurons within given range of bins."""
     num_dep = len(dep_matrices)
@@ -990,27 +1075,60 @@ def _extract_dependent_p_conn(adj, dep_matrices, dep_bins):
 
     # Extract connection probability
     num_bins = [len(b) - 1 for b in dep_bins]
-    bin_indices = [list(range(n)) for n in num_bins]
-    count_all = np.full(num_bins, -1) # Count of all pairs of neurons for each combination of dependencies
-    count_conn = np.full(num_bins, -1) # Count of connected pairs of neurons for each combination of dependencies
+    num_bins_total = np.prod(num_bins, dtype=int)
 
     logging.info(f'Extracting {num_dep}-dimensional ({"x".join([str(n) for n in num_bins])}) connection probabilities...')
-    for idx in tqdm.tqdm(itertools.product(*bin_indices), total=np.prod(num_bins)):
-        dep_sel = np.full(adj.shape, True)
+
+    # Values of all pairs of neurons for each dependency
+    # (in case of sparse dependency matrices, only the stored pairs are considered)
+    if sps.issparse(dep_matrices[0]):
+        dep_matrices = [sps.coo_matrix(m) for m in dep_matrices]
+        pair_rows = dep_matrices[0].row
+        pair_cols = dep_matrices[0].col
+        assert np.all([np.array_equal(m.row, pair_rows) and np.array_equal(m.col, pair_cols) for m in dep_matrices]), 'ERROR: Sparse matrices must contain the same pairs!'
+        dep_values = [m.data for m in dep_matrices]
+    else:
+        pair_rows = pair_cols = None
+        dep_values = [np.ravel(m) for m in dep_matrices]
+
+    # Positions of existing connections among all pairs of neurons
+    adj = sps.coo_matrix(adj)
+    conn_idx = np.ravel_multi_index((adj.row, adj.col), adj.shape)
+    conn_weights = adj.data
+    if pair_rows is not None: # Look up connections among the stored pairs
+        pair_idx = np.ravel_multi_index((pair_rows, pair_cols), adj.shape)
+        pair_order = np.argsort(pair_idx)
+        pos = np.searchsorted(pair_idx, conn_idx, sorter=pair_order)
+        conn_sel = pos < len(pair_idx)
+        conn_sel[conn_sel] = pair_idx[pair_order[pos[conn_sel]]] == conn_idx[conn_sel]
+        conn_idx = pair_order[pos[conn_sel]]
+        conn_weights = conn_weights[conn_sel]
+    conn_order = np.argsort(conn_idx)
+    conn_idx = conn_idx[conn_order]
+    conn_weights = conn_weights[conn_order]
+
+    # Count of all/connected pairs of neurons for each combination of dependencies,
+    # accumulated over blocks of pairs (to limit the size of temporary arrays)
+    block_size = 2**22
+    num_pairs = len(dep_values[0])
+    count_all = np.zeros(num_bins_total, dtype=int)
+    count_conn = np.zeros(num_bins_total)
+    for start in range(0, num_pairs, block_size):
+        stop = min(start + block_size, num_pairs)
+        # Linear bin id (row-major over all dependencies) of each pair; out-of-range pairs get an extra id
+        lin_id = np.zeros(stop - start, dtype=int)
+        out_of_range = np.zeros(stop - start, dtype=bool)
         for dim in range(num_dep):
-            lower = dep_bins[dim][idx[dim]]
-            upper = dep_bins[dim][idx[dim] + 1]
-            dep_sel = np.logical_and(dep_sel, np.logical_and(dep_matrices[dim] >= lower, (dep_matrices[dim] < upper) if idx[dim] < num_bins[dim] - 1 else (dep_matrices[dim] <= upper))) # Including last edge
-        sidx, tidx = np.nonzero(dep_sel)
-        count_all[idx] = np.sum(dep_sel)
-        ### count_conn[idx] = np.sum(adj[sidx, tidx]) # ERROR in scipy/sparse/compressed.py if len(sidx) >= 2**31: "ValueError: could not convert integer scalar"
-        # [WORKAROUND]: Split indices into parts of 2**31-1 length and sum them separately
-        sidx_split = np.split(sidx, np.arange(0, len(sidx), 2**31-1)[1:])
-        tidx_split = np.split(tidx, np.arange(0, len(tidx), 2**31-1)[1:])
-        count_split = 0
-        for s, t in zip(sidx_split, tidx_split):
-            count_split = count_split + np.sum(adj[s, t])
-        count_conn[idx] = count_split
+            dep_idx = _get_bin_indices(dep_values[dim][start:stop], dep_bins[dim])
+            lin_id = lin_id * num_bins[dim] + dep_idx
+            out_of_range |= dep_idx < 0
+        lin_id[out_of_range] = num_bins_total
+        _add_bin_id_counts(count_all, lin_id)
+        conn_start, conn_stop = np.searchsorted(conn_idx, [start, stop])
+        _add_bin_id_counts(count_conn, lin_id[conn_idx[conn_start:conn_stop] - start], weights=conn_weights[conn_start:conn_stop])
+    count_all = count_all.reshape(num_bins)
+    count_conn = count_conn.astype(int).reshape(num_bins)
+
     p_conn = np.array(count_conn / count_all)
 #     p_conn[np.isnan(p_conn)] = 0.0
 
@@ -1037,31 +1155,32 @@ def _extract_2nd_order(adj, node_properties, bin_size_um=100, max_range_um=None,
     pos_table = node_properties[coord_names].to_numpy()
 
     if N_split == 0: # Compute all at once
-        # Compute distance matrix
-        dist_mat = _compute_dist_matrix_symmetric(pos_table)
-
-        # Extract distance-dependent connection probabilities
+        # Compute distance matrix (sparse, if max. range given)
         if max_range_um is None:
+            dist_mat = _compute_dist_matrix_symmetric(pos_table)
             max_range_um = np.nanmax(dist_mat)
-        num_bins = np.ceil(max_range_um / bin_size_um).astype(int)
-        dist_bins = np.arange(0, num_bins + 1) * bin_size_um
+            num_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+        else:
+            num_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+            dist_mat = _compute_dist_matrix_symmetric(pos_table, dist_bins[-1])
 
+        # Extract distance-dependent connection probabilities
         p_conn_dist, count_conn, count_all = _extract_dependent_p_conn(adj, [dist_mat], [dist_bins])
 
     else: # Split computation into N_split data splits (to reduce memory consumption)
         assert max_range_um is not None, f'ERROR: Max. range must be specified if data extraction splitted into {N_split} parts!'
-        num_bins = np.ceil(max_range_um / bin_size_um).astype(int)
-        dist_bins = np.arange(0, num_bins + 1) * bin_size_um
+        num_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
 
         count_conn = np.zeros(num_bins, dtype=int)
         count_all = np.zeros(num_bins, dtype=int)
+        tgt_tree = spt.cKDTree(pos_table) # Target positions shared by all splits
         for sidx, split_sel in enumerate(split_indices):
             if part_idx is not None and part_idx != sidx:
                 continue
             logging.info(f'<SPLIT {sidx + 1} of {N_split}>')
 
-            # Compute distance matrix
-            dist_mat_split = _compute_dist_matrix(pos_table[split_sel, :], pos_table)
+            # Compute sparse distance matrix (only pairs within range)
+            dist_mat_split = _compute_sparse_dist_matrix(spt.cKDTree(pos_table[split_sel, :]), tgt_tree, dist_bins[-1])
 
             # Extract distance-dependent connection counts
             _, count_conn_split, count_all_split = _extract_dependent_p_conn(adj[split_sel, :], [dist_mat_split], [dist_bins])
@@ -1087,15 +1206,16 @@ def _extract_2nd_order_pathway(adj, node_properties_src, node_properties_tgt, bi
     pos_table_src = node_properties_src[coord_names].to_numpy()
     pos_table_tgt = node_properties_tgt[coord_names].to_numpy()
 
-    # Compute distance matrix
-    dist_mat = _compute_dist_matrix(pos_table_src, pos_table_tgt)
-
-    # Extract distance-dependent connection probabilities
+    # Compute distance matrix (sparse, if max. range given)
     if max_range_um is None:
+        dist_mat = _compute_dist_matrix(pos_table_src, pos_table_tgt)
         max_range_um = np.nanmax(dist_mat)
-    num_bins = np.ceil(max_range_um / bin_size_um).astype(int)
-    dist_bins = np.arange(0, num_bins + 1) * bin_size_um
+        num_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+    else:
+        num_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+        dist_mat = _compute_dist_matrix(pos_table_src, pos_table_tgt, dist_bins[-1])
 
+    # Extract distance-dependent connection probabilities
     p_conn_dist, count_conn, count_all = _extract_dependent_p_conn(adj, [dist_mat], [dist_bins])
 
     return {'p_conn_dist': p_conn_dist, 'count_conn': count_conn, 'count_all': count_all, 'dist_bins': dist_bins}
@@ -1116,7 +1236,7 @@ def _build_2nd_order(p_conn_dist, dist_bins, **_):
 
     logging.info(f'MODEL FIT: f(x) = {exp_model_scale:.6f} * exp(-{exp_model_exponent:.6f} * x)')
 
-    model = 'exp_model_scale * np.exp(-exp_model_exponent * np.array(d))'
+    model = EXP_MODEL
     model_inputs = ['d']
     model_params = {'exp_model_scale': exp_model_scale, 'exp_model_exponent': exp_model_exponent}
 
@@ -1125,6 +1245,7 @@ def _build_2nd_order(p_conn_dist, dist_bins, **_):
 
 def _plot_2nd_order(adj, node_properties, model_name, p_conn_dist, count_conn, count_all, dist_bins, model, model_inputs, model_params, plot_dir=None, **_):
     """Visualize data vs. model (2nd order)."""
+    assert model == EXP_MODEL, 'ERROR: Plotting only supported for exponential model!'
     if plot_dir is not None:
         if not os.path.exists(plot_dir):
             os.makedirs(plot_dir)
@@ -1133,8 +1254,6 @@ def _plot_2nd_order(adj, node_properties, model_name, p_conn_dist, count_conn, c
     dist_model = np.linspace(dist_bins[0], dist_bins[-1], 100)
 
     model_str = f'f(x) = {model_params["exp_model_scale"]:.3f} * exp(-{model_params["exp_model_exponent"]:.3f} * x)'
-    model_fct = _get_model_function(model, model_inputs, model_params)
-
     if isinstance(node_properties, list):
         N_pre = node_properties[0].shape[0]  # Pre-synaptic population
         N_post = node_properties[1].shape[0]  # Post-synaptic population
@@ -1147,7 +1266,7 @@ def _plot_2nd_order(adj, node_properties, model_name, p_conn_dist, count_conn, c
     plt.subplot(1, 2, 1)
     plt.step(dist_bins, np.hstack([p_conn_dist[0], p_conn_dist]), color=DATA_COLOR, label=f'Data: N = {N_pre}x{N_post} cells')
     plt.plot(dist_bins[:-1] + bin_offset, p_conn_dist, '.', color=DATA_COLOR)
-    plt.plot(dist_model, model_fct(dist_model), '--', color=MODEL_COLOR, label='Model: ' + model_str)
+    plt.plot(dist_model, _exp_model(dist_model, **model_params), '--', color=MODEL_COLOR, label='Model: ' + model_str)
     plt.grid()
     plt.xlabel('Distance ($\\mu$m)')
     plt.ylabel('Conn. prob.')
@@ -1160,9 +1279,8 @@ def _plot_2nd_order(adj, node_properties, model_name, p_conn_dist, count_conn, c
     r_markers = [200, 400] # (um)
     dx = np.linspace(-plot_range, plot_range, 201)
     dz = np.linspace(plot_range, -plot_range, 201)
-    xv, zv = np.meshgrid(dx, dz)
-    vdist = np.sqrt(xv**2 + zv**2)
-    pdist = model_fct(vdist)
+    vdist = np.hypot(dx[np.newaxis, :], dz[:, np.newaxis])
+    pdist = _exp_model(vdist, **model_params) # Radial model, evaluated directly on the distance grid
     plt.imshow(pdist, interpolation='bilinear', extent=(-plot_range, plot_range, -plot_range, plot_range), cmap=PROB_CMAP, vmin=0.0)
     for r in r_markers:
         plt.gca().add_patch(plt.Circle((0, 0), r, edgecolor='w', linestyle='--', fill=False))
@@ -1222,39 +1340,45 @@ def _extract_3rd_order(adj, node_properties, bin_size_um=100, max_range_um=None,
     depth_table = node_properties[depth_name].to_numpy()
 
     if N_split == 0: # Compute all at once
-        # Compute distance matrix
-        dist_mat = _compute_dist_matrix_symmetric(pos_table)
+        if max_range_um is None:
+            # Compute distance matrix
+            dist_mat = _compute_dist_matrix_symmetric(pos_table)
 
-        # Compute bipolar matrix (post-synaptic neuron below (delta_d < 0) or above (delta_d > 0) pre-synaptic neuron)
-        bip_mat = _compute_bip_matrix(depth_table, depth_table)
+            # Compute bipolar matrix (post-synaptic neuron below (delta_d < 0) or above (delta_d > 0) pre-synaptic neuron)
+            bip_mat = _compute_bip_matrix(depth_table, depth_table)
 
-        # Extract bipolar distance-dependent connection probabilities
-        if max_range_um is None:
             max_range_um = np.nanmax(dist_mat)
-        num_dist_bins = np.ceil(max_range_um / bin_size_um).astype(int)
-        dist_bins = np.arange(0, num_dist_bins + 1) * bin_size_um
-        bip_bins = [np.nanmin(bip_mat), 0, np.nanmax(bip_mat)]
+            num_dist_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+            bip_bins = [np.nanmin(bip_mat), 0, np.nanmax(bip_mat)]
+        else:
+            num_dist_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+            bip_bins = [-1, 0, 1]
 
+            # Compute sparse distance and bipolar matrices (only pairs within range)
+            dist_mat = _compute_dist_matrix_symmetric(pos_table, dist_bins[-1])
+            bip_mat = _compute_bip_matrix_sparse(depth_table, depth_table, dist_mat)
+
+        # Extract bipolar distance-dependent connection probabilities
         p_conn_dist_bip, count_conn, count_all = _extract_dependent_p_conn(adj, [dist_mat, bip_mat], [dist_bins, bip_bins])
 
     else: # Split computation into N_split data splits (to reduce memory consumption)
         assert max_range_um is not None, f'ERROR: Max. range must be specified if data extraction splitted into {N_split} parts!'
-        num_dist_bins = np.ceil(max_range_um / bin_size_um).astype(int)
-        dist_bins = np.arange(0, num_dist_bins + 1) * bin_size_um
+        num_dist_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
         bip_bins = [-1, 0, 1]
 
         count_conn = np.zeros([num_dist_bins, 2], dtype=int)
         count_all = np.zeros([num_dist_bins, 2], dtype=int)
+        tgt_tree = spt.cKDTree(pos_table) # Target positions shared by all splits
         for sidx, split_sel in enumerate(split_indices):
             if part_idx is not None and part_idx != sidx:
                 continue
             logging.info(f'<SPLIT {sidx + 1} of {N_split}>')
 
-            # Compute distance matrix
-            dist_mat_split = _compute_dist_matrix(pos_table[split_sel, :], pos_table)
+            # Compute sparse distance matrix (only pairs within range)
+            dist_mat_split = _compute_sparse_dist_matrix(spt.cKDTree(pos_table[split_sel, :]), tgt_tree, dist_bins[-1])
 
             # Compute bipolar matrix (post-synaptic neuron below (delta_d < 0) or above (delta_d > 0) pre-synaptic neuron)
-            bip_mat_split = _compute_bip_matrix(depth_table[split_sel], depth_table)
+            bip_mat_split = _compute_bip_matrix_sparse(depth_table[split_sel], depth_table, dist_mat_split)
 
             # Extract distance-dependent connection counts
             _, count_conn_split, count_all_split = _extract_dependent_p_conn(adj[split_sel, :], [dist_mat_split, bip_mat_split], [dist_bins, bip_bins])
@@ -1284,19 +1408,25 @@ def _extract_3rd_order_pathway(adj, node_properties_src, node_properties_tgt, bi
     depth_table_src = node_properties_src[depth_name].to_numpy()
     depth_table_tgt = node_properties_tgt[depth_name].to_numpy()
 
-    # Compute distance matrix
-    dist_mat = _compute_dist_matrix(pos_table_src, pos_table_tgt)
+    if max_range_um is None:
+        # Compute distance matrix
+        dist_mat = _compute_dist_matrix(pos_table_src, pos_table_tgt)
 
-    # Compute bipolar matrix (post-synaptic neuron below (delta_d < 0) or above (delta_d > 0) pre-synaptic neuron)
-    bip_mat = _compute_bip_matrix(depth_table_src, depth_table_tgt)
+        # Compute bipolar matrix (post-synaptic neuron below (delta_d < 0) or above (delta_d > 0) pre-synaptic neuron)
+        bip_mat = _compute_bip_matrix(depth_table_src, depth_table_tgt)
 
-    # Extract bipolar distance-dependent connection probabilities
-    if max_range_um is None:
         max_range_um = np.nanmax(dist_mat)
-    num_dist_bins = np.ceil(max_range_um / bin_size_um).astype(int)
-    dist_bins = np.arange(0, num_dist_bins + 1) * bin_size_um
-    bip_bins = [np.nanmin(bip_mat), 0, np.nanmax(bip_mat)]
+        num_dist_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+        bip_bins = [np.nanmin(bip_mat), 0, np.nanmax(bip_mat)]
+    else:
+        num_dist_bins, dist_bins = _get_dist_bins(max_range_um, bin_size_um)
+        bip_bins = [-1, 0, 1]
+
+        # Compute sparse distance and bipolar matrices (only pairs within range)
+        dist_mat = _compute_dist_matrix(pos_table_src, pos_table_tgt, dist_bins[-1])
+        bip_mat = _compute_bip_matrix_sparse(depth_table_src, depth_table_tgt, dist_mat)
 
+    # Extract bipolar distance-dependent connection probabilities
     p_conn_dist_bip, count_conn, count_all = _extract_dependent_p_conn(adj, [dist_mat, bip_mat], [dist_bins, bip_bins])
 
     return {'p_conn_dist_bip': p_conn_dist_bip, 'count_conn': count_conn, 'count_all': count_all, 'dist_bins': dist_bins, 'bip_bins': bip_bins}
@@ -1322,7 +1452,7 @@ def _build_3rd_order(p_conn_dist_bip, dist_bins, **_):
     logging.info(f'                              {bip_pos_exp_model_scale:.6f} * exp(-{bip_pos_exp_model_exponent:.6f} * x) if dz > 0')
     logging.info('                              AVERAGE OF BOTH MODELS  if dz == 0')
 
-    model = 'np.select([np.array(dz) < 0, np.array(dz) > 0, np.array(dz) == 0], [bip_neg_exp_model_scale * np.exp(-bip_neg_exp_model_exponent * np.array(d)), bip_pos_exp_model_scale * np.exp(-bip_pos_exp_model_exponent * np.array(d)), 0.5 * (bip_neg_exp_model_scale * np.exp(-bip_neg_exp_model_exponent * np.array(d)) + bip_pos_exp_model_scale * np.exp(-bip_pos_exp_model_exponent * np.array(d)))])'
+    model = BIP_EXP_MODEL
     model_inputs = ['d', 'dz']
     model_params = {'bip_neg_exp_model_scale': bip_neg_exp_model_scale, 'bip_neg_exp_model_exponent': bip_neg_exp_model_exponent, 'bip_pos_exp_model_scale': bip_pos_exp_model_scale, 'bip_pos_exp_model_exponent': bip_pos_exp_model_exponent}
 
@@ -1331,6 +1461,7 @@ def _build_3rd_order(p_conn_dist_bip, dist_bins, **_):
 
 def _plot_3rd_order(adj, node_properties, model_name, p_conn_dist_bip, count_conn, count_all, dist_bins, model, model_inputs, model_params, plot_dir=None, **_):
     """Visualize data vs. model (3rd order)."""
+    assert model == BIP_EXP_MODEL, 'ERROR: Plotting only supported for bipolar exponential model!'
     if plot_dir is not None:
         if not os.path.exists(plot_dir):
             os.makedirs(plot_dir)
@@ -1340,8 +1471,6 @@ def _plot_3rd_order(adj, node_properties, model_name, p_conn_dist_bip, count_con
 
     model_strN = f'{model_params["bip_neg_exp_model_scale"]:.3f} * exp(-{model_params["bip_neg_exp_model_exponent"]:.3f} * x)'
     model_strP = f'{model_params["bip_pos_exp_model_scale"]:.3f} * exp(-{model_params["bip_pos_exp_model_exponent"]:.3f} * x)'
-    model_fct = _get_model_function(model, model_inputs, model_params)
-
     if isinstance(node_properties, list):
         N_pre = node_properties[0].shape[0]  # Pre-synaptic population
         N_post = node_properties[1].shape[0]  # Post-synaptic population
@@ -1358,8 +1487,8 @@ def _plot_3rd_order(adj, node_properties, model_name, p_conn_dist_bip, count_con
     bin_data = np.concatenate((p_conn_dist_bip[::-1, 0], p_conn_dist_bip[:, 1]))
     plt.step(all_bins, np.hstack([bin_data[0], bin_data]), color=DATA_COLOR, label=f'Data: N = {N_pre}x{N_post} cells')
     plt.plot(bip_dist, bip_data, '.', color=DATA_COLOR)
-    plt.plot(-dist_model, model_fct(dist_model, np.sign(-dist_model)), '--', color=MODEL_COLOR, label='Model: ' + model_strN)
-    plt.plot(dist_model, model_fct(dist_model, np.sign(dist_model)), '--', color=MODEL_COLOR2, label='Model: ' + model_strP)
+    plt.plot(-dist_model, _bip_exp_model(dist_model, -dist_model, **model_params), '--', color=MODEL_COLOR, label='Model: ' + model_strN)
+    plt.plot(dist_model, _bip_exp_model(dist_model, dist_model, **model_params), '--', color=MODEL_COLOR2, label='Model: ' + model_strP)
     plt.grid()
     plt.xlabel('sign($\\Delta$z) * Distance [$\\mu$m]')
     plt.ylabel('Conn. prob.')
@@ -1372,9 +1501,11 @@ def _plot_3rd_order(adj, node_properties, model_name, p_conn_dist_bip, count_con
     r_markers = [200, 400] # (um)
     dx = np.linspace(-plot_range, plot_range, 201)
     dz = np.linspace(plot_range, -plot_range, 201)
-    xv, zv = np.meshgrid(dx, dz)
-    vdist = np.sqrt(xv**2 + zv**2)
-    pdist = model_fct(vdist, np.sign(zv))
+    vdist = np.hypot(dx[np.newaxis, :], dz[:, np.newaxis])
+    p_neg = _exp_model(vdist, model_params['bip_neg_exp_model_scale'], model_params['bip_neg_exp_model_exponent'])
+    p_pos = _exp_model(vdist, model_params['bip_pos_exp_model_scale'], model_params['bip_pos_exp_model_exponent'])
+    zv = dz[:, np.newaxis]
+    pdist = np.where(zv > 0, p_pos, np.where(zv < 0, p_neg, 0.5 * (p_neg + p_pos))) # Combine exp. branches by sign of dz
     plt.imshow(pdist, interpolation='bilinear', extent=(-plot_range, plot_range, -plot_range, plot_range), cmap=PROB_CMAP, vmin=0.0)
     plt.plot(plt.xlim(), np.zeros(2), 'w', linewidth=0.5)
     for r in r_markers:
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import logging
 import networkx as nx
 import numpy as np
 import pandas as pd
@@ -347,15 +348,39 @@ def common_neighbor_connectivity_bias(adj, neuron_properties=None, direction="ef
 
 #TODO ADD CODE FROM CLUSTER OR WITH CONNECTOM UTILITIES CODE TO COMPUTE PROBABILITY OF CONNECTION PER PATHWAY OR ANY OTHER PROPERTIE ON THE NEURON_PROPERTY.
 
-def gini_curve(m, nrn, direction='efferent'):
-    m = m.tocsc()
+def _degrees(m, direction='efferent'):
+    # Weighted degrees (sums over columns for 'afferent', over rows for 'efferent') as a flat array
     if direction == 'afferent':
-        degrees = np.array(m.sum(axis=0)).flatten()
+        return np.asarray(m.sum(axis=0)).ravel()
     elif direction == 'efferent':
-        degrees = np.array(m.sum(axis=1).flatten())
+        return np.asarray(m.sum(axis=1)).ravel()
     else:
         raise Exception("Unknown value for argument direction: %s" % direction)
-    cs = np.cumsum(np.flipud(sorted(degrees))).astype(float) / np.sum(degrees)
+
+
+def _check_diagonal(rows, cols):
+    # Warns about non-zero diagonal entries (as node_degree does), given the rows and columns of the non-zero entries
+    if np.any(rows == cols):
+        logging.warning('The diagonal is non-zero!  This may cause errors in the analysis')
+
+
+def _coo_degrees(M, direction=None):
+    # Number of non-zero entries per row ('OUT'), per column ('IN') or both (None) of a COO matrix
+    assert not direction or direction in ("IN", "OUT") or tuple(direction) == ("IN", "OUT"),\
+        f"Invalid `direction`: {direction}"
+    nz = M.data != 0
+    _check_diagonal(M.row[nz], M.col[nz])
+    if direction == "OUT":
+        return np.bincount(M.row[nz], minlength=M.shape[0])
+    elif direction == "IN":
+        return np.bincount(M.col[nz], minlength=M.shape[1])
+    else:
+        return np.bincount(M.row[nz], minlength=M.shape[0]) + np.bincount(M.col[nz], minlength=M.shape[1])
+
+
+def gini_curve(m, nrn, direction='efferent'):
+    degrees = _degrees(m, direction=direction)
+    cs = np.cumsum(np.sort(degrees)[::-1], dtype=np.float64) / np.sum(degrees)
     return pd.Series(cs, index=np.linspace(0, 1, len(cs)))
 
 
@@ -424,19 +449,27 @@ def rich_club_curve(m, direction='TOTAL'):
     -----
     The rich-club coefficient is a measure of the tendency of high-degree nodes to form tightly interconnected communities.
     """
-    m = sp.csc_matrix(m)
+    m = sp.csc_matrix(m).tocoo()
     if direction == 'TOTAL': direction = None 
-    degrees = node_degree(m, direction=direction)
+    degrees = _coo_degrees(m, direction=direction)
     if m.dtype == bool:
         udegrees = np.arange(1, degrees.max() + 1)
         ret_x = udegrees
     else:
         ret_x, udegrees, degrees = _bin_degrees(degrees)
 
-    edge_counter = lambda i: (degrees >= i).sum() * ((degrees >= i).sum() - 1)  # number of pot. edges
-    mat_counter = lambda i: m[np.ix_(degrees >= i, degrees >= i)].sum()  # number of actual edges
-    ret = (np.array([mat_counter(i) for i in udegrees]).astype(float)
-           / np.array([edge_counter(i) for i in udegrees]))
+    # Rank nodes by decreasing degree, so that the nodes with degree >= i are the top-ranked ones.
+    # An edge is then contained in the top-k nodes iff the larger rank of its endpoints is < k.
+    order = np.argsort(-degrees, kind='stable')
+    rank = np.empty(len(degrees), dtype=int)
+    rank[order] = np.arange(len(degrees))
+    edge_rank = np.maximum(rank[m.row], rank[m.col])
+    cum_edges = np.hstack([0, np.cumsum(np.bincount(edge_rank, weights=m.data, minlength=len(degrees)))])
+
+    node_counts = np.searchsorted(-degrees[order], -np.asarray(udegrees), side='right')  # number of nodes with degree >= i
+    edge_counter = node_counts * (node_counts - 1)  # number of pot. edges
+    mat_counter = cum_edges[node_counts]  # number of actual edges
+    ret = mat_counter.astype(float) / edge_counter
     return pd.Series(ret, index=pd.Index(ret_x, name="degree"))
 
 
@@ -469,32 +502,36 @@ def efficient_rich_club_curve(M, direction="TOTAL", pre_calculated_filtration=No
     The rich-club coefficient is a measure of the tendency of high-degree nodes (nodes with a high filtration value) to form tightly interconnected communities.
     """
     #TODO: Maybe expand the notes explaining this concept.
+    M = sp.coo_matrix(M, copy=True)
+    M.sum_duplicates()
+    M.eliminate_zeros()
+    shape = M.shape
+    if direction=="TOTAL": direction = None
+
+    if pre_calculated_filtration is None and sparse_bin_set == False:
+        _check_diagonal(M.row, M.col)
+        return _batched_rich_club_curves(M.row[None, :], M.col[None, :], shape[0], direction=direction)[0].rename(None)
+
     if pre_calculated_filtration is not None:
-        deg = pre_calculated_filtration
+        deg = pre_calculated_filtration.values
+        deg_arr = np.zeros(shape[0], dtype=int)
+        deg_arr[pre_calculated_filtration.index.values] = deg
     else:
-        if direction=="TOTAL": direction = None 
-        deg=node_degree(M,direction=direction)
-    M = M.tocoo()
-    shape = M.shape
-    M = pd.DataFrame.from_dict({"row": M.row, "col": M.col})
-    
-    
+        deg_arr = _coo_degrees(M, direction=direction)
+        deg = deg_arr
 
     if sparse_bin_set == False:
         degree_bins = np.arange(deg.max() + 2)
     elif sparse_bin_set == True:
         degree_bins = np.unique(np.append(deg, [0, deg.max() + 1]))
     degree_bins_rv = degree_bins[-2::-1]
-    nrn_degree_distribution = np.histogram(deg.values, bins=degree_bins)[0]
+    nrn_degree_distribution = np.histogram(deg, bins=degree_bins)[0] # Filtration values may be negative or non-integer
     nrn_cum_degrees = np.cumsum(nrn_degree_distribution[-1::-1])
     nrn_cum_pairs = nrn_cum_degrees * (nrn_cum_degrees - 1)
 
-    deg_arr = np.zeros(shape[0], dtype=int)
-    deg_arr[deg.index.values] = deg.values
-
     deg = None
 
-    con_degree = np.minimum(deg_arr[M["row"].values], deg_arr[M["col"].values])
+    con_degree = np.minimum(deg_arr[M.row], deg_arr[M.col])
     M = None
     con_degree = np.histogram(con_degree, bins=degree_bins)[0]
 
@@ -506,8 +543,8 @@ def efficient_rich_club_curve(M, direction="TOTAL", pre_calculated_filtration=No
 
 def _analytical_expected_rich_club_curve(m, direction='efferent'):
     assert m.dtype == bool, "This function only works for binary matrices at the moment"
-    indegree = np.array(m.sum(axis=0))[0]
-    outdegree = np.array(m.sum(axis=1))[:, 0]
+    indegree = _degrees(m, direction='afferent')
+    outdegree = _degrees(m, direction='efferent')
 
     if direction == 'afferent':
         degrees = indegree
@@ -517,29 +554,39 @@ def _analytical_expected_rich_club_curve(m, direction='efferent'):
         raise Exception("Unknown value for argument direction: %s" % direction)
 
     udegrees = np.arange(1, degrees.max() + 1)
-    edge_counter = lambda i: (degrees >= i).sum() * ((degrees >= i).sum() - 1)
+
+    # Sort nodes by decreasing degree, so that the nodes with degree >= i are the first ones
+    order = np.argsort(-degrees, kind='stable')
+    indeg_sorted = indegree[order].astype(float)  # Float, to avoid integer overflows in the variance
+    outdeg_sorted = outdegree[order].astype(float)
+    cum_indeg = np.cumsum(indeg_sorted)
+    node_counts = np.searchsorted(-degrees[order], -udegrees, side='right')
     res_mn = []
     res_sd = []
-    for deg in udegrees:
-        valid = np.nonzero(degrees >= deg)[0]
-        i_v = indegree[valid]
+    for k in node_counts:
+        i_v = indeg_sorted[:k]
         i_sum_all = indegree.sum() - i_v
-        i_sum_s = i_v.sum() - i_v
-        o_v = outdegree[valid]
-        S = np.array([hypergeom.stats(_ia, _is, o)
-                      for _ia, _is, o in zip(i_sum_all, i_sum_s, o_v)])
-        res_mn.append(np.sum(S[:, 0]) / edge_counter(deg))
-        res_sd.append(np.sqrt(S[:, 1].sum()) / edge_counter(deg))  # Sum the variances, but divide the std
+        i_sum_s = cum_indeg[k - 1] - i_v
+        o_v = outdeg_sorted[:k]
+        # Hypergeometric mean and variance of (population i_sum_all, successes i_sum_s, draws o_v)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mn = o_v * i_sum_s / i_sum_all
+            var = o_v * i_sum_s * (i_sum_all - i_sum_s) * (i_sum_all - o_v) / (i_sum_all ** 2 * (i_sum_all - 1))
+        invalid = (i_sum_s > i_sum_all) | (o_v > i_sum_all)
+        mn[invalid] = np.nan
+        var[invalid] = np.nan
+        edge_counter = k * (k - 1)
+        res_mn.append(np.sum(mn) / edge_counter)
+        res_sd.append(np.sqrt(np.sum(var)) / edge_counter)  # Sum the variances, but divide the std
     df = pd.DataFrame.from_dict({"mean": np.array(res_mn),
                                  "std": np.array(res_sd)})
     df.index = udegrees
     return df
 
 
-def generate_degree_based_control(M, direction="efferent"):
-    # A shuffled version of a connectivity matrix that aims to preserve degree distributions.
-    # If direction = "efferent", then the out-degree is exactly preserved, while the in-degree is
-    # approximately preseved. Otherwise it's the other way around.
+def _degree_based_control_indices(M, direction="efferent", n=1):
+    # Draws n degree-based controls of M at once (see generate_degree_based_control). Returns M as CSR
+    # (efferent) or CSC (afferent) matrix, together with an (n, nnz) array of new M.indices for each control.
     if direction == "efferent":
         M = M.tocsr()
         idxx = np.arange(M.shape[1])
@@ -551,22 +598,99 @@ def generate_degree_based_control(M, direction="efferent"):
     else:
         raise ValueError()
 
-    for col in range(M.shape[1]):
+    # Weighted sampling without replacement for all columns (of all controls) at once: indices are drawn by
+    # inverse-CDF sampling, and autapses and repeated indices within a column are rejected and drawn again.
+    # Keeping the first distinct draws is equivalent to sequential sampling without replacement.
+    k_all = np.diff(M.indptr)
+    n_valid = np.count_nonzero(p_out) - (p_out > 0)
+    if np.any(k_all > n_valid):
+        raise ValueError("Fewer non-zero entries in p than size")
+    n_cols = len(k_all)
+    cols = np.tile(np.repeat(np.arange(n_cols), k_all), n) # Column of each entry
+    groups = np.repeat(np.arange(n), M.nnz) * n_cols + cols # Control and column of each entry (contiguous)
+    cdf = np.cumsum(p_out)
+    indices = np.empty(len(cols), dtype=int)
+    taken = np.array([np.iinfo(np.int64).max]) # Sorted keys of accepted entries (with end marker)
+    todo = np.arange(len(cols))
+    for rnd in range(10):
+        if len(todo) == 0:
+            break
+        indices[todo] = np.searchsorted(cdf, np.random.random(len(todo)) * cdf[-1], side='right')
+        # Only the new draws are checked: one draw per new key is accepted, unless it is an autapse or already taken
+        keys = groups[todo] * len(idxx) + indices[todo]
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        first = np.hstack([True, sorted_keys[1:] != sorted_keys[:-1]])
+        new_keys = sorted_keys[first]
+        new_pos = order[first]
+        pos = np.searchsorted(taken, new_keys)
+        valid = (taken[pos] != new_keys) & (indices[todo[new_pos]] != cols[todo[new_pos]])
+        taken = np.insert(taken, pos[valid], new_keys[valid])
+        rejected = np.ones(len(todo), dtype=bool)
+        rejected[new_pos[valid]] = False
+        todo = todo[rejected]
+    # Columns that still miss indices (i.e., most of their candidates are taken): draw the rest directly
+    accepted = np.ones(len(cols), dtype=bool)
+    accepted[todo] = False
+    pending, group_starts = np.unique(groups[todo], return_index=True)
+    for group, group_todo in zip(pending, np.split(todo, group_starts[1:])):
+        col = group % n_cols
+        group_sel = slice((group // n_cols) * M.nnz + M.indptr[col], (group // n_cols) * M.nnz + M.indptr[col + 1])
         p = p_out.copy()
         p[col] = 0.0
+        p[indices[group_sel][accepted[group_sel]]] = 0.0
         p = p / p.sum()
-        a = M.indptr[col]
-        b = M.indptr[col + 1]
-        M.indices[a:b] = np.random.choice(idxx, b - a, p=p, replace=False)
+        indices[group_todo] = np.random.choice(idxx, len(group_todo), p=p, replace=False)
+    return M, indices.reshape(n, M.nnz)
+
+
+def generate_degree_based_control(M, direction="efferent"):
+    # A shuffled version of a connectivity matrix that aims to preserve degree distributions.
+    # If direction = "efferent", then the out-degree is exactly preserved, while the in-degree is
+    # approximately preseved. Otherwise it's the other way around.
+    M, indices = _degree_based_control_indices(M, direction=direction)
+    M.indices[:] = indices[0]
+    M.has_sorted_indices = False
     return M
 
 
+def _batched_rich_club_curves(rows, cols, num_nodes, direction=None):
+    # Rich-club curves w.r.t. out- ('OUT'), in- ('IN') or total degree (None) with integer degree bins (as in
+    # efficient_rich_club_curve) of a batch of graphs on the same nodes, given by (n, nnz) arrays of edge rows
+    # and columns. Returns a data frame with one column per graph.
+    assert not direction or direction in ("IN", "OUT") or tuple(direction) == ("IN", "OUT"),\
+        f"Invalid `direction`: {direction}"
+    rows, cols = np.broadcast_arrays(rows, cols)
+    n = rows.shape[0]
+    node_offsets = np.arange(n)[:, None] * num_nodes
+    deg = np.zeros(n * num_nodes, dtype=int)
+    if direction != "IN":
+        deg += np.bincount((rows + node_offsets).ravel(), minlength=n * num_nodes)
+    if direction != "OUT":
+        deg += np.bincount((cols + node_offsets).ravel(), minlength=n * num_nodes)
+    deg = deg.reshape(n, num_nodes)
+
+    num_degrees = deg.max() + 1
+    degree_offsets = np.arange(n)[:, None] * num_degrees
+    nrn_degree_distribution = np.bincount((deg + degree_offsets).ravel(), minlength=n * num_degrees).reshape(n, num_degrees)
+    nrn_cum_degrees = np.cumsum(nrn_degree_distribution[:, ::-1], axis=1)
+    nrn_cum_pairs = nrn_cum_degrees * (nrn_cum_degrees - 1)
+
+    con_degree = np.minimum(np.take_along_axis(deg, rows, axis=1), np.take_along_axis(deg, cols, axis=1))
+    con_degree = np.bincount((con_degree + degree_offsets).ravel(), minlength=n * num_degrees).reshape(n, num_degrees)
+    cum_degrees = np.cumsum(con_degree[:, ::-1], axis=1)
+
+    return pd.DataFrame((cum_degrees / nrn_cum_pairs)[:, ::-1].T, index=np.arange(num_degrees))
+
+
 def _randomized_control_rich_club_curve(m, direction='efferent', n=10):
-    res = []
-    for _ in range(n):
-        m_shuf = generate_degree_based_control(m, direction=direction)
-        res.append(efficient_rich_club_curve(m_shuf))
-    res = pd.concat(res, axis=1)
+    # All n controls are drawn at once from m; they only differ in the minor indices of their entries
+    M, indices = _degree_based_control_indices(m, direction=direction, n=n)
+    major = np.repeat(np.arange(len(M.indptr) - 1), np.diff(M.indptr))[None, :]
+    if direction == "efferent":
+        res = _batched_rich_club_curves(major, indices, M.shape[0])
+    else:
+        res = _batched_rich_club_curves(indices, major, M.shape[0])
     #TODO: Something is wrong here. rr is not defined. Should it be res?
     #      But changing rr to res causing 
     df = pd.DataFrame.from_dict(
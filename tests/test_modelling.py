@@ -0,0 +1,58 @@
+# SPDX-FileCopyrightText: 2024 Blue Brain Project / EPFL
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import numpy as np
+from scipy import sparse
+
+
+def test_extract_dependent_p_conn():
+    from connalysis.modelling.modelling import _extract_dependent_p_conn, _compute_dist_matrix_symmetric
+    rng = np.random.default_rng(0)
+    pos = rng.uniform(0, 300, (60, 3))
+    adj = sparse.random(60, 60, density=0.2, random_state=0, format='csr').astype(bool)
+    adj.setdiag(False)
+    adj.eliminate_zeros()
+    dist_mat = _compute_dist_matrix_symmetric(pos)
+    dist_bins = np.arange(0, 6) * 100
+    p_conn, count_conn, count_all = _extract_dependent_p_conn(adj, [dist_mat], [dist_bins])
+
+    # Reference counts (last bin including its upper edge)
+    dense_adj = adj.toarray()
+    for idx in range(len(dist_bins) - 1):
+        upper_sel = dist_mat < dist_bins[idx + 1] if idx < len(dist_bins) - 2 else dist_mat <= dist_bins[idx + 1]
+        sel = np.logical_and(dist_mat >= dist_bins[idx], upper_sel)
+        assert count_all[idx] == np.sum(sel)
+        assert count_conn[idx] == np.sum(dense_adj[sel])
+    np.testing.assert_array_equal(p_conn, count_conn / count_all)
+
+
+def test_extract_dependent_p_conn_sparse():
+    from connalysis.modelling.modelling import (_extract_dependent_p_conn, _compute_dist_matrix,
+                                                _compute_bip_matrix, _compute_bip_matrix_sparse)
+    rng = np.random.default_rng(1)
+    pos = rng.uniform(0, 300, (60, 3))
+    depths = np.round(rng.uniform(0, 3, 60))
+    adj = sparse.random(60, 60, density=0.2, random_state=1, format='csr').astype(bool)
+    dist_bins = np.arange(0, 3) * 100
+    bip_bins = [-1, 0, 1]
+    dense_res = _extract_dependent_p_conn(adj, [_compute_dist_matrix(pos, pos), _compute_bip_matrix(depths, depths)], [dist_bins, bip_bins])
+    dist_mat = _compute_dist_matrix(pos, pos, dist_bins[-1])
+    sparse_res = _extract_dependent_p_conn(adj, [dist_mat, _compute_bip_matrix_sparse(depths, depths, dist_mat)], [dist_bins, bip_bins])
+    for d, s in zip(dense_res, sparse_res):
+        np.testing.assert_array_equal(d, s)
+
+
+def test_get_model_function():
+    from connalysis.modelling.modelling import _get_model_function, EXP_MODEL, BIP_EXP_MODEL
+    d = np.linspace(0, 500, 11)
+    dz = np.sign(np.linspace(-1, 1, 11))
+    exp_params = {'exp_model_scale': 0.3, 'exp_model_exponent': 0.01}
+    np.testing.assert_allclose(_get_model_function(EXP_MODEL, ['d'], exp_params)(d), 0.3 * np.exp(-0.01 * d))
+    bip_params = {'bip_neg_exp_model_scale': 0.3, 'bip_neg_exp_model_exponent': 0.01,
+                  'bip_pos_exp_model_scale': 0.2, 'bip_pos_exp_model_exponent': 0.02}
+    p_neg = 0.3 * np.exp(-0.01 * d)
+    p_pos = 0.2 * np.exp(-0.02 * d)
+    np.testing.assert_allclose(_get_model_function(BIP_EXP_MODEL, ['d', 'dz'], bip_params)(d, dz),
+                               np.select([dz < 0, dz > 0], [p_neg, p_pos], 0.5 * (p_neg + p_pos)))
+    np.testing.assert_allclose(_get_model_function('a * d + b', ['d'], {'a': 2.0, 'b': 1.0})(d), 2.0 * d + 1.0)
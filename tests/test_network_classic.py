@@ -0,0 +1,142 @@
+# SPDX-FileCopyrightText: 2024 Blue Brain Project / EPFL
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import numpy as np
+from scipy import sparse
+
+
+def _random_adj(n=80, density=0.08, seed=0):
+    A = sparse.random(n, n, density=density, random_state=seed, format='csr').astype(bool)
+    A.setdiag(False)
+    A.eliminate_zeros()
+    return A
+
+
+def test_rich_club_curves():
+    from connalysis.network.classic import rich_club_curve, efficient_rich_club_curve
+    A = _random_adj()
+    for direction in ['OUT', 'IN', 'TOTAL']:
+        rc = rich_club_curve(A, direction=direction)
+        erc = efficient_rich_club_curve(A, direction=direction)
+        np.testing.assert_allclose(erc[rc.index].values, rc.values)
+
+
+def test_generate_degree_based_control():
+    from connalysis.network.classic import generate_degree_based_control
+    A = _random_adj()
+    for direction, axis in [('efferent', 1), ('afferent', 0)]:
+        C = generate_degree_based_control(A.copy(), direction=direction)
+        C.sum_duplicates()
+        assert C.nnz == A.nnz
+        assert C.diagonal().sum() == 0
+        np.testing.assert_array_equal(C.sum(axis=axis), A.sum(axis=axis))
+
+
+def test_degree_based_control_dense():
+    from connalysis.network.classic import _degree_based_control_indices
+    # Dense matrix with a full row/column: most draws collide, so several rejection rounds and the fallback are needed
+    A = _random_adj(n=30, density=0.9, seed=1).tolil()
+    A[0, 1:] = True
+    A[1:, 0] = True
+    A = A.tocsr()
+    np.random.seed(0)
+    for direction, axis in [('efferent', 1), ('afferent', 0)]:
+        M, indices = _degree_based_control_indices(A, direction=direction, n=5)
+        for idx in indices:
+            C = M.copy()
+            C.indices[:] = idx
+            C.has_sorted_indices = False
+            C.sum_duplicates()
+            assert C.nnz == A.nnz
+            assert C.diagonal().sum() == 0
+            np.testing.assert_array_equal(C.sum(axis=axis), A.sum(axis=axis))
+
+
+def test_batched_rich_club_curves():
+    from connalysis.network.classic import rich_club_curve, _batched_rich_club_curves, _degree_based_control_indices
+    A = _random_adj()
+    np.random.seed(0)
+    M, indices = _degree_based_control_indices(A, direction='efferent', n=3)
+    rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+    for direction in ['OUT', 'IN', None]:
+        res = _batched_rich_club_curves(rows[None, :], indices, M.shape[0], direction=direction)
+        for idx, col in zip(indices, res.columns):
+            C = sparse.csr_matrix((np.ones(len(idx), dtype=bool), idx, M.indptr), shape=M.shape)
+            rc = rich_club_curve(C, direction=direction or 'TOTAL')
+            np.testing.assert_allclose(res[col][rc.index].values, rc.values)
+
+
+def test_randomized_control_rich_club_curve():
+    from connalysis.network.classic import _randomized_control_rich_club_curve
+    A = _random_adj()
+    A_orig = A.copy()
+    np.random.seed(0)
+    for direction in ['efferent', 'afferent']:
+        df = _randomized_control_rich_club_curve(A, direction=direction, n=5)
+        assert list(df.columns) == ['mean', 'std']
+        assert np.all(df['mean'].dropna().between(0, 1))
+        assert np.all(df['std'].dropna() >= 0)
+        assert (A != A_orig).nnz == 0  # Controls are drawn from the original matrix, which is left unchanged
+
+
+def test_analytical_expected_rich_club_curve():
+    from scipy.stats import hypergeom
+    from connalysis.network.classic import _analytical_expected_rich_club_curve
+    star = np.zeros((4, 4), dtype=bool)
+    star[0, 1:] = True  # Degenerate hypergeometric parameters (NaN results)
+    for A in [_random_adj(n=20, density=0.2, seed=2), sparse.csr_matrix(star)]:
+        indegree = np.asarray(A.sum(axis=0)).ravel()
+        outdegree = np.asarray(A.sum(axis=1)).ravel()
+        for direction, degrees in [('efferent', outdegree), ('afferent', indegree)]:
+            df = _analytical_expected_rich_club_curve(A, direction=direction)
+            for deg in df.index:
+                valid = degrees >= deg
+                i_v = indegree[valid]
+                S = np.array([hypergeom.stats(_ia, _is, o) for _ia, _is, o
+                              in zip(indegree.sum() - i_v, i_v.sum() - i_v, outdegree[valid])], dtype=float)
+                edge_counter = valid.sum() * (valid.sum() - 1)
+                np.testing.assert_allclose(df.loc[deg, 'mean'], S[:, 0].sum() / edge_counter)
+                np.testing.assert_allclose(df.loc[deg, 'std'], np.sqrt(S[:, 1].sum()) / edge_counter)
+
+
+def test_gini_curve():
+    from connalysis.network.classic import gini_curve
+    A = sparse.csr_matrix(np.array([[0, 1, 0, 0],
+                                    [1, 0, 1, 1],
+                                    [0, 0, 0, 0],
+                                    [1, 1, 0, 0]], dtype=bool))
+    gc = gini_curve(A, None, direction='efferent')  # Out-degrees 1, 3, 0, 2
+    np.testing.assert_allclose(gc.values, [3 / 6, 5 / 6, 1.0, 1.0])
+    np.testing.assert_allclose(gc.index, [0, 1 / 3, 2 / 3, 1])
+    gc = gini_curve(A, None, direction='afferent')  # In-degrees 2, 2, 1, 1
+    np.testing.assert_allclose(gc.values, [2 / 6, 4 / 6, 5 / 6, 1.0])
+
+
+def test_rich_club_curves_diagonal_warning(caplog):
+    from connalysis.network.classic import rich_club_curve, efficient_rich_club_curve
+    A = _random_adj().tolil()
+    A[0, 0] = True
+    for fct in [rich_club_curve, efficient_rich_club_curve]:
+        caplog.clear()
+        fct(A.tocsr())
+        assert 'The diagonal is non-zero' in caplog.text
+    caplog.clear()
+    efficient_rich_club_curve(_random_adj())
+    assert 'The diagonal is non-zero' not in caplog.text
+
+
+def test_rich_club_curve_negative_filtration():
+    import pandas as pd
+    from connalysis.network.classic import efficient_rich_club_curve
+    A = _random_adj(n=40, density=0.1).tocoo()
+    filtration = pd.Series(np.random.default_rng(0).integers(-3, 10, 40))
+    rc = efficient_rich_club_curve(A, pre_calculated_filtration=filtration)
+
+    # Reference with histogram counts (values below 0 are dropped)
+    deg = filtration.values
+    degree_bins = np.arange(deg.max() + 2)
+    nrn_cum = np.cumsum(np.histogram(deg, bins=degree_bins)[0][::-1])
+    con_cum = np.cumsum(np.histogram(np.minimum(deg[A.row], deg[A.col]), bins=degree_bins)[0][::-1])
+    np.testing.assert_array_equal(rc.index, degree_bins[:-1])
+    np.testing.assert_allclose(rc.values, (con_cum / (nrn_cum * (nrn_cum - 1)))[::-1])